@@ -1,32 +1,201 @@
 #!/usr/bin/env python3
+"""
+Create a sampled subset of a JSONL dataset, either a fixed number of lines
+(reservoir sampling) or a fraction of them.
+
+    python scripts/jsonl_sample.py --input data.jsonl --output sample.jsonl --size 10000
+    python scripts/jsonl_sample.py --input data.jsonl --output sample.jsonl --fraction 0.1 --workers 8
+
+Once reading and writing are buffered, the per-line loop is plain Python, so
+the script also runs under PyPy, whose JIT speeds that loop up considerably:
+
+    pypy3 -m pip install numpy xxhash
+    pypy3 scripts/jsonl_sample.py --input data.jsonl --output sample.jsonl --size 10000
+
+Only the standard library, numpy and xxhash are required, and all three
+support PyPy. simdjson and orjson are optional. When they cannot be installed,
+--validate falls back to the json module.
+"""
 import argparse
+import codecs
 import json
+import math
+import mmap
+import multiprocessing
 import os
-import random
-from typing import Iterable, List, Tuple
+import shutil
+import tempfile
+from typing import Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import xxhash
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_READ_CHUNK_SIZE = 4 << 20
+_WRITE_BUFFER_SIZE = 4 << 20
+
+# A single parser is reused across lines so its internal buffers are only
+# allocated once; the parsed document is discarded right away.
+_PARSER = simdjson.Parser() if simdjson is not None else None
 
 
-def iter_lines(filepath: str) -> Iterable[Tuple[int, str]]:
+def iter_lines(
+    filepath: str,
+    chunk_size: int = _READ_CHUNK_SIZE,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> Iterable[Tuple[int, bytes]]:
     """
     Stream file line by line yielding (position, raw_line).
-    Position is 1-based physical line number in the input file.
+    Position is 1-based physical line number counted from byte offset start.
+    The file is read in large binary chunks and split on b"\n"; lines are
+    yielded as raw bytes without the trailing newline.
+    start/end restrict reading to the byte range [start, end); start should be
+    the beginning of a line.
     """
-    with open(filepath, "r", encoding="utf-8") as f:
-        for position, line in enumerate(f, start=1):
-            yield position, line
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        os.lseek(fd, start, os.SEEK_SET)
+        remaining = end - start if end is not None else None
+        position = 0
+        tail = b""
+        while remaining is None or remaining > 0:
+            read_size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = os.read(fd, read_size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                position += 1
+                yield position, line
+        if tail:
+            yield position + 1, tail
+    finally:
+        os.close(fd)
 
 
-def validate_jsonl_line(raw_line: str) -> bool:
+def split_line_ranges(filepath: str, num_parts: int) -> List[Tuple[int, int]]:
+    """
+    Split a file into at most num_parts byte ranges [start, end) whose
+    boundaries fall on line starts, so every line belongs to exactly one range.
+    """
+    size = os.path.getsize(filepath)
+    if size == 0 or num_parts <= 1:
+        return [(0, size)]
+    boundaries = [0]
+    with open(filepath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(1, num_parts):
+                offset = size * i // num_parts
+                boundary = mm.rfind(b"\n", 0, offset) + 1
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _reject_constant(name: str) -> None:
+    raise ValueError(f"{name} is not valid JSON")
+
+
+def _parse_finite_float(value: str) -> float:
+    number = float(value)
+    if math.isinf(number):
+        raise ValueError(f"{value} is out of range")
+    return number
+
+
+def validate_jsonl_line(raw_line: Union[bytes, str]) -> bool:
     """
     Return True if the raw_line is valid JSON; otherwise False.
+    Uses simdjson or orjson when available, falling back to the stdlib json module.
+    All three apply strict JSON: NaN/Infinity and numbers that overflow a double are
+    rejected, integers of any size are accepted and a leading UTF-8 BOM is ignored,
+    so the sampled output does not depend on which parser is installed. The one
+    difference left is that only simdjson and orjson reject lone surrogate escapes
+    such as "\\ud800".
     """
+    if isinstance(raw_line, str):
+        raw_line = raw_line.encode("utf-8")
+    if raw_line.startswith(codecs.BOM_UTF8):
+        raw_line = raw_line[len(codecs.BOM_UTF8) :]
+    if _PARSER is not None:
+        try:
+            _PARSER.parse(raw_line)
+            return True
+        except ValueError:
+            return False
+        except RuntimeError:
+            # Valid JSON that simdjson cannot represent (integers beyond 64 bits), or
+            # the parser is still held by an earlier document, which happens on PyPy
+            # where documents are not freed right away; leave it to the next parser.
+            pass
+    if orjson is not None:
+        try:
+            orjson.loads(raw_line)
+            return True
+        except (orjson.JSONDecodeError, ValueError):
+            return False
     try:
-        json.loads(raw_line)
+        json.loads(
+            raw_line, parse_constant=_reject_constant, parse_float=_parse_finite_float
+        )
         return True
     except Exception:
         return False
 
 
+class _UniformStream:
+    """
+    Uniform random floats in the open interval (0, 1), drawn from a seeded
+    numpy Generator in batches so that each draw is a buffer read rather than
+    a call into the RNG.
+    """
+
+    def __init__(self, seed: int, batch_size: int = 4096) -> None:
+        # numpy rejects negative seeds; wrap them like the hash seed of fraction mode
+        self._rng = np.random.default_rng(seed & 0xFFFFFFFFFFFFFFFF)
+        self._batch_size = batch_size
+        self._buf: List[float] = []
+        self._pos = 0
+
+    def next(self) -> float:
+        while True:
+            if self._pos == len(self._buf):
+                self._buf = self._rng.random(self._batch_size).tolist()
+                self._pos = 0
+            u = self._buf[self._pos]
+            self._pos += 1
+            if u > 0.0:
+                return u
+
+    def index(self, n: int) -> int:
+        """
+        Return a uniform random integer in [0, n).
+        """
+        return min(int(self.next() * n), n - 1)
+
+
+def _reservoir_skip(uniform: _UniformStream, w: float) -> int:
+    """
+    Number of valid lines to pass over before the next reservoir replacement
+    (Algorithm L, geometric with success probability w).
+    """
+    return math.floor(math.log(uniform.next()) / math.log1p(-w))
+
+
 def sample_fixed_size(
     input_path: str,
     output_path: str,
@@ -37,16 +206,21 @@ def sample_fixed_size(
 ) -> Tuple[int, int]:
     """
     Reservoir sample exactly up to sample_size lines from a JSONL file in a single pass.
+    - Uses Vitter's Algorithm L, so only O(k log(N/k)) random draws are made
     - Preserves original order of sampled lines in the output
     - If there are fewer valid lines than sample_size, writes all valid lines
 
     Returns (num_total_lines_seen, num_valid_lines_seen)
     """
-    random.seed(seed)
+    uniform = _UniformStream(seed)
 
-    reservoir: List[Tuple[int, str]] = []  # (position, raw_line)
+    reservoir: List[Tuple[int, bytes]] = []  # (position, raw_line)
     valid_seen = 0
     total_seen = 0
+    # Algorithm L state: w is the running threshold and next_pick the
+    # 1-based index of the next valid line that enters the reservoir.
+    w = 0.0
+    next_pick = 0
 
     for pos, raw in iter_lines(input_path):
         total_seen += 1
@@ -56,52 +230,122 @@ def sample_fixed_size(
 
         if len(reservoir) < sample_size:
             reservoir.append((pos, raw))
-        else:
-            j = random.randint(1, valid_seen)
-            if j <= sample_size:
-                reservoir[j - 1] = (pos, raw)
+            if len(reservoir) == sample_size:
+                w = math.exp(math.log(uniform.next()) / sample_size)
+                next_pick = valid_seen + _reservoir_skip(uniform, w) + 1
+        elif valid_seen == next_pick:
+            reservoir[uniform.index(sample_size)] = (pos, raw)
+            w *= math.exp(math.log(uniform.next()) / sample_size)
+            next_pick += _reservoir_skip(uniform, w) + 1
 
     # Preserve input order
     reservoir.sort(key=lambda x: x[0])
 
     os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
-    with open(output_path, "w", encoding="utf-8") as out_f:
+    with open(output_path, "wb") as out_f:
+        buf = bytearray()
         for _, raw in reservoir:
-            out_f.write(raw)
+            buf += raw
+            buf += b"\n"
+            if len(buf) >= _WRITE_BUFFER_SIZE:
+                out_f.write(buf)
+                buf.clear()
+        out_f.write(buf)
 
     return total_seen, valid_seen
 
 
-def sample_fraction(
+def _sample_fraction_range(
     input_path: str,
     output_path: str,
     fraction: float,
-    *,
-    seed: int = 42,
-    validate: bool = False,
+    seed: int,
+    validate: bool,
+    start: int = 0,
+    end: Optional[int] = None,
 ) -> Tuple[int, int, int]:
     """
-    Stream sample each valid line with probability=fraction. Deterministic via seed.
+    Sample the lines in the byte range [start, end) of input_path into output_path.
     Returns (num_total_lines_seen, num_valid_lines_seen, num_written)
     """
-    assert 0.0 < fraction <= 1.0, "fraction must be in (0, 1]"
-    random.seed(seed)
+    # keep a line iff its 64-bit hash falls below fraction * 2**64
+    threshold = int(fraction * (1 << 64))
+    hash_seed = seed & 0xFFFFFFFFFFFFFFFF
 
     total_seen = 0
     valid_seen = 0
     written = 0
 
-    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
-    with open(output_path, "w", encoding="utf-8") as out_f:
-        for _, raw in iter_lines(input_path):
+    with open(output_path, "wb") as out_f:
+        buf = bytearray()
+        for _, raw in iter_lines(input_path, start=start, end=end):
             total_seen += 1
             if validate and not validate_jsonl_line(raw):
                 continue
             valid_seen += 1
-            if random.random() < fraction:
-                out_f.write(raw)
+            if xxhash.xxh3_64_intdigest(raw, seed=hash_seed) < threshold:
+                buf += raw
+                buf += b"\n"
                 written += 1
+                if len(buf) >= _WRITE_BUFFER_SIZE:
+                    out_f.write(buf)
+                    buf.clear()
+        out_f.write(buf)
+
+    return total_seen, valid_seen, written
+
+
+def sample_fraction(
+    input_path: str,
+    output_path: str,
+    fraction: float,
+    *,
+    seed: int = 42,
+    validate: bool = False,
+    workers: int = 1,
+) -> Tuple[int, int, int]:
+    """
+    Stream sample each valid line with probability=fraction. Deterministic via seed.
+    A line is kept based on a seeded xxh3 hash of its content, so the output does
+    not depend on how the input is split; identical lines are kept or dropped together.
+    With workers > 1 the input is split into line-aligned byte ranges that are
+    sampled in parallel processes and concatenated in order.
+    Returns (num_total_lines_seen, num_valid_lines_seen, num_written)
+    """
+    assert 0.0 < fraction <= 1.0, "fraction must be in (0, 1]"
+
+    output_dir = os.path.dirname(output_path) or "."
+    os.makedirs(output_dir, exist_ok=True)
+
+    ranges = split_line_ranges(input_path, workers)
+    if len(ranges) == 1:
+        return _sample_fraction_range(input_path, output_path, fraction, seed, validate)
+
+    part_paths = []
+    try:
+        for _ in ranges:
+            fd, part_path = tempfile.mkstemp(dir=output_dir, suffix=".part")
+            os.close(fd)
+            part_paths.append(part_path)
+
+        tasks = [
+            (input_path, part_path, fraction, seed, validate, start, end)
+            for part_path, (start, end) in zip(part_paths, ranges)
+        ]
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            results = pool.starmap(_sample_fraction_range, tasks)
 
+        with open(output_path, "wb") as out_f:
+            for part_path in part_paths:
+                with open(part_path, "rb") as part_f:
+                    shutil.copyfileobj(part_f, out_f, _WRITE_BUFFER_SIZE)
+    finally:
+        for part_path in part_paths:
+            os.remove(part_path)
+
+    total_seen = sum(r[0] for r in results)
+    valid_seen = sum(r[1] for r in results)
+    written = sum(r[2] for r in results)
     return total_seen, valid_seen, written
 
 
@@ -123,6 +367,12 @@ def parse_args() -> argparse.Namespace:
         help="Fraction in (0,1] of valid lines to keep (streaming)",
     )
     parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used for --fraction sampling",
+    )
     parser.add_argument(
         "--validate",
         action="store_true",
@@ -152,6 +402,7 @@ def main() -> None:
             fraction=args.fraction,
             seed=args.seed,
             validate=args.validate,
+            workers=args.workers,
         )
         print(
             f"Sampled fraction={args.fraction:.6f} -> wrote {written} lines "
@@ -161,5 +412,3 @@ def main() -> None:
 
 if __name__ == "__main__":
     main()
-
-
@@ -4,41 +4,23 @@ from typing import List, Optional, Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from transformers import Qwen3Config
+from torch.nn.attention.flex_attention import create_block_mask, flex_attention
+from transformers import Qwen3Config, modeling_utils
 from transformers.cache_utils import Cache
 from transformers.modeling_rope_utils import ROPE_INIT_FUNCTIONS, dynamic_rope_update
 
-from .base import Eagle3DraftModel
-from torch.nn.attention.flex_attention import create_block_mask, flex_attention
 from specforge.modeling.draft.flex_attention import (
     compile_friendly_create_block_mask,
     compile_friendly_flex_attention,
     generate_eagle3_mask,
 )
 
+from .base import Eagle3DraftModel
 
 logger = logging.getLogger(__name__)
 
 
-def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
-    """
-    Repeat KV heads from (batch, num_kv, seq, head_dim) to (batch, num_attn, seq, head_dim)
-    """
-    batch, num_key_value_heads, slen, head_dim = hidden_states.shape
-    if n_rep == 1:
-        return hidden_states
-    hidden_states = hidden_states[:, :, None, :, :].expand(
-        batch, num_key_value_heads, n_rep, slen, head_dim
-    )
-    return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
-
-
-def rotate_half(x: torch.Tensor) -> torch.Tensor:
-    x1 = x[..., : x.shape[-1] // 2]
-    x2 = x[..., x.shape[-1] // 2 :]
-    return torch.cat((-x2, x1), dim=-1)
-
-
+@torch.compile(dynamic=True)
 def apply_rotary_pos_emb(
     q: torch.Tensor,
     k: torch.Tensor,
@@ -46,13 +28,42 @@ def apply_rotary_pos_emb(
     sin: torch.Tensor,
     unsqueeze_dim: int = 1,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
-    cos = cos.unsqueeze(unsqueeze_dim)
-    sin = sin.unsqueeze(unsqueeze_dim)
-    q_embed = (q * cos) + (rotate_half(q) * sin)
-    k_embed = (k * cos) + (rotate_half(k) * sin)
+    # cos/sin repeat the same frequencies in both halves, so rotate the two
+    # halves of q and k directly instead of materializing rotate_half(q/k).
+    half = q.shape[-1] // 2
+    cos = cos[..., :half].unsqueeze(unsqueeze_dim)
+    sin = sin[..., :half].unsqueeze(unsqueeze_dim)
+    q1, q2 = q.chunk(2, dim=-1)
+    k1, k2 = k.chunk(2, dim=-1)
+    q_embed = torch.cat((q1 * cos - q2 * sin, q2 * cos + q1 * sin), dim=-1)
+    k_embed = torch.cat((k1 * cos - k2 * sin, k2 * cos + k1 * sin), dim=-1)
     return q_embed, k_embed
 
 
+def rms_norm(hidden_states: torch.Tensor, weight: torch.Tensor, eps: float) -> torch.Tensor:
+    # Only the reduction runs in fp32: vector_norm accumulates in its dtype argument
+    # without materializing an fp32 copy of the input, the scaling stays in the input dtype.
+    variance = torch.linalg.vector_norm(hidden_states, dim=-1, keepdim=True, dtype=torch.float32).pow(2)
+    inv_rms = torch.rsqrt(variance / hidden_states.size(-1) + eps).to(hidden_states.dtype)
+    return weight * (hidden_states * inv_rms)
+
+
+@torch.compile(dynamic=True)
+def norm_qk(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    q_weight: torch.Tensor,
+    k_weight: torch.Tensor,
+    eps: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Head-wise RMSNorm of q and k fused into a single compiled graph, so the
+    normalization is computed right after the projection instead of as two
+    extra passes over q and k.
+    """
+    return rms_norm(q, q_weight, eps), rms_norm(k, k_weight, eps)
+
+
 class Qwen3RMSNorm(nn.Module):
     def __init__(self, hidden_size: int, eps: float = 1e-6) -> None:
         super().__init__()
@@ -60,11 +71,7 @@ class Qwen3RMSNorm(nn.Module):
         self.variance_epsilon = eps
 
     def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
-        input_dtype = hidden_states.dtype
-        hidden_states = hidden_states.to(torch.float32)
-        variance = hidden_states.pow(2).mean(-1, keepdim=True)
-        hidden_states = hidden_states * torch.rsqrt(variance + self.variance_epsilon)
-        return self.weight * hidden_states.to(input_dtype)
+        return rms_norm(hidden_states, self.weight, self.variance_epsilon)
 
 
 class Qwen3RotaryEmbedding(nn.Module):
@@ -86,12 +93,43 @@ class Qwen3RotaryEmbedding(nn.Module):
         self.register_buffer("inv_freq", inv_freq, persistent=False)
         self.original_inv_freq = self.inv_freq
 
+        # Static rope types only depend on the position, so cos/sin are tabulated once
+        # and indexed in forward. Dynamic types rescale inv_freq with the sequence
+        # length and are still computed on the fly.
+        if "dynamic" in self.rope_type or self.rope_type == "longrope":
+            self.cos_cached = None
+            self.sin_cached = None
+        else:
+            self._set_cos_sin_cache(self.max_seq_len_cached, device=self.inv_freq.device)
+
+    def _set_cos_sin_cache(self, seq_len: int, device: torch.device) -> None:
+        self.max_seq_len_cached = seq_len
+        t = torch.arange(seq_len, device=device, dtype=torch.float32)
+        freqs = torch.outer(t, self.inv_freq.to(device=device, dtype=torch.float32))
+        emb = torch.cat((freqs, freqs), dim=-1)
+        self.register_buffer("cos_cached", emb.cos() * self.attention_scaling, persistent=False)
+        self.register_buffer("sin_cached", emb.sin() * self.attention_scaling, persistent=False)
+
     @torch.no_grad()
+    def forward(
+        self, x: torch.Tensor, position_ids: torch.Tensor, seq_len: Optional[int] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Return (cos, sin) of shape [bsz, seq_len, head_dim] for position_ids.
+        seq_len is an upper bound on position_ids + 1, used to grow the cached tables.
+        """
+        if self.cos_cached is None:
+            return self._compute_cos_sin(x, position_ids)
+        if seq_len is not None and seq_len > self.max_seq_len_cached:
+            self._set_cos_sin_cache(seq_len, device=x.device)
+        elif self.cos_cached.device != x.device:
+            # tables are built on the inputs' device once, so the slices below need no copy
+            self._set_cos_sin_cache(self.max_seq_len_cached, device=x.device)
+        return self.cos_cached[position_ids].to(dtype=x.dtype), self.sin_cached[position_ids].to(dtype=x.dtype)
+
     @dynamic_rope_update
-    def forward(self, x: torch.Tensor, position_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        inv_freq_expanded = (
-            self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1).to(x.device)
-        )
+    def _compute_cos_sin(self, x: torch.Tensor, position_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
         position_ids_expanded = position_ids[:, None, :].float()
 
         device_type = x.device.type if isinstance(x.device.type, str) and x.device.type != "mps" else "cpu"
@@ -104,19 +142,61 @@ class Qwen3RotaryEmbedding(nn.Module):
         return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
 
 
+def fuse_linear_weights(state_dict: dict, prefix: str, fused_name: str, names: List[str]) -> None:
+    """
+    Concatenate the weights of separate linear layers (e.g. gate_proj/up_proj) from a
+    checkpoint into the weight of the fused layer, in place, along the output dim.
+    """
+    keys = [f"{prefix}{name}.weight" for name in names]
+    if all(key in state_dict for key in keys):
+        state_dict[f"{prefix}{fused_name}.weight"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+
+def split_linear_weights(
+    state_dict: dict, prefix: str, fused_name: str, names: List[str], split_sizes: List[int]
+) -> None:
+    """
+    Inverse of fuse_linear_weights: split the weight of the fused layer back into the
+    weights of the separate linear layers, in place, along the output dim.
+    """
+    key = f"{prefix}{fused_name}.weight"
+    if key in state_dict:
+        # clone so that the saved tensors do not share storage
+        for name, weight in zip(names, state_dict.pop(key).split(split_sizes, dim=0)):
+            state_dict[f"{prefix}{name}.weight"] = weight.clone()
+
+
 class Qwen3MLP(nn.Module):
     def __init__(self, config: Qwen3Config) -> None:
         super().__init__()
         self.config = config
         self.hidden_size = config.hidden_size
         self.intermediate_size = config.intermediate_size
-        self.gate_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
-        self.up_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
+        # gate_proj and up_proj fused into one [2 * intermediate, hidden] projection
+        self.gate_up_proj = nn.Linear(self.hidden_size, 2 * self.intermediate_size, bias=False)
         self.down_proj = nn.Linear(self.intermediate_size, self.hidden_size, bias=False)
         self.act_fn = F.silu if config.hidden_act == "silu" else getattr(F, config.hidden_act)
+        self.register_load_state_dict_pre_hook(self._load_unfused_weights)
+
+    @staticmethod
+    def _load_unfused_weights(module: nn.Module, state_dict: dict, prefix: str, *args) -> None:
+        module.fuse_state_dict(state_dict, prefix)
+
+    def fuse_state_dict(self, state_dict: dict, prefix: str = "") -> None:
+        fuse_linear_weights(state_dict, prefix, "gate_up_proj", ["gate_proj", "up_proj"])
+
+    def unfuse_state_dict(self, state_dict: dict, prefix: str = "") -> None:
+        split_linear_weights(
+            state_dict,
+            prefix,
+            "gate_up_proj",
+            ["gate_proj", "up_proj"],
+            [self.intermediate_size, self.intermediate_size],
+        )
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
+        gate, up = self.gate_up_proj(x).chunk(2, dim=-1)
+        return self.down_proj(self.act_fn(gate) * up)
 
 
 class Qwen3Attention(nn.Module):
@@ -132,9 +212,13 @@ class Qwen3Attention(nn.Module):
 
         # projections take concatenated [input_embeds ; hidden_states]
         in_features = self.hidden_size * 2
-        self.q_proj = nn.Linear(in_features, self.num_heads * self.head_dim, bias=False)
-        self.k_proj = nn.Linear(in_features, self.num_key_value_heads * self.head_dim, bias=False)
-        self.v_proj = nn.Linear(in_features, self.num_key_value_heads * self.head_dim, bias=False)
+        # q_proj, k_proj and v_proj fused into one projection, split in forward
+        self.qkv_split_sizes = [
+            self.num_heads * self.head_dim,
+            self.num_key_value_heads * self.head_dim,
+            self.num_key_value_heads * self.head_dim,
+        ]
+        self.qkv_proj = nn.Linear(in_features, sum(self.qkv_split_sizes), bias=False)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
 
         # Qwen3-specific per-head RMSNorm on q and k
@@ -143,6 +227,26 @@ class Qwen3Attention(nn.Module):
 
         # rotary
         self.rotary_emb = Qwen3RotaryEmbedding(config=config)
+        self.register_load_state_dict_pre_hook(self._load_unfused_weights)
+
+    @staticmethod
+    def _load_unfused_weights(module: nn.Module, state_dict: dict, prefix: str, *args) -> None:
+        module.fuse_state_dict(state_dict, prefix)
+
+    def fuse_state_dict(self, state_dict: dict, prefix: str = "") -> None:
+        fuse_linear_weights(state_dict, prefix, "qkv_proj", ["q_proj", "k_proj", "v_proj"])
+
+    def unfuse_state_dict(self, state_dict: dict, prefix: str = "") -> None:
+        split_linear_weights(state_dict, prefix, "qkv_proj", ["q_proj", "k_proj", "v_proj"], self.qkv_split_sizes)
+
+    def _norm_qk(self, query_states: torch.Tensor, key_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return norm_qk(
+            query_states,
+            key_states,
+            self.q_norm.weight,
+            self.k_norm.weight,
+            self.q_norm.variance_epsilon,
+        )
 
     def forward(
         self,
@@ -156,27 +260,22 @@ class Qwen3Attention(nn.Module):
     ) -> torch.Tensor:
         bsz, q_len, _ = hidden_states.size()
 
-        query_states = self.q_proj(hidden_states)
-        key_states = self.k_proj(hidden_states)
-        value_states = self.v_proj(hidden_states)
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).split(self.qkv_split_sizes, dim=-1)
 
-        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
-        key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
+        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim)
+        key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
         # Qwen3 head-wise norm before RoPE
-        query_states = self.q_norm(query_states)
-        key_states = self.k_norm(key_states)
+        query_states, key_states = self._norm_qk(query_states, key_states)
+        query_states = query_states.transpose(1, 2)
+        key_states = key_states.transpose(1, 2)
 
         if cache_hidden is None:
             # rotary
-            cos, sin = self.rotary_emb(query_states, position_ids)
-            cos, sin = cos.to(query_states.device), sin.to(query_states.device)
+            cos, sin = self.rotary_emb(query_states, position_ids, seq_len=q_len)
             query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
 
-            key_states = repeat_kv(key_states, self.num_key_value_groups)
-            value_states = repeat_kv(value_states, self.num_key_value_groups)
-
             attn_output = torch.nn.functional.scaled_dot_product_attention(
                 query_states,
                 key_states,
@@ -184,16 +283,13 @@ class Qwen3Attention(nn.Module):
                 attn_mask=attention_mask,
                 is_causal=attention_mask is None,
                 dropout_p=0.0,
+                enable_gqa=True,
             )
         else:
             lck = len(cache_hidden[0])
-            cos, sin = self.rotary_emb(query_states, position_ids + lck)
-            cos, sin = cos.to(query_states.device), sin.to(query_states.device)
+            cos, sin = self.rotary_emb(query_states, position_ids + lck, seq_len=q_len + lck)
             query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
 
-            key_states = repeat_kv(key_states, self.num_key_value_groups)
-            value_states = repeat_kv(value_states, self.num_key_value_groups)
-
             cache_hidden[0] = cache_hidden[0] + [key_states]
             cache_hidden[1] = cache_hidden[1] + [value_states]
 
@@ -203,32 +299,40 @@ class Qwen3Attention(nn.Module):
             k0 = cache_k[0]
             v0 = cache_v[0]
 
-            attn_weights = torch.matmul(query_states, k0.transpose(2, 3)) / (self.head_dim ** 0.5)
+            # GQA: view the query heads as [kv_heads, groups] so that every kv head
+            # is shared by its group of query heads without being repeated
+            query_groups = query_states.unflatten(1, (self.num_key_value_heads, self.num_key_value_groups))
+
+            attn_weights = torch.matmul(query_groups.flatten(2, 3), k0.transpose(2, 3)) / (self.head_dim ** 0.5)
+            attn_weights = attn_weights.view(bsz, self.num_heads, q_len, q_len)
             lck = len(cache_k)
 
             attn_weights = attn_weights + attention_mask
 
-            for i in range(1, lck):
-                ki = cache_k[i]
-                qi = query_states
-                kiq = ki
-
-                attn_weightsi = (qi * kiq).sum(-1) / (self.head_dim ** 0.5)
-                attn_weights = torch.cat((attn_weights, attn_weightsi[..., None]), dim=-1)
+            if lck > 1:
+                # keys/values from later TTT steps are only attended at the same
+                # position, so score them for all steps with one batched matmul:
+                # [bsz, kv_heads, q_len, groups, head_dim] @ [bsz, kv_heads, q_len, head_dim, lck - 1]
+                k_rest = torch.stack(cache_k[1:], dim=-2)
+                v_rest = torch.stack(cache_v[1:], dim=-2)
+                attn_weights_rest = torch.matmul(query_groups.transpose(2, 3), k_rest.transpose(-1, -2))
+                attn_weights_rest = attn_weights_rest.transpose(2, 3).flatten(1, 2) / (self.head_dim ** 0.5)
+                attn_weights = torch.cat((attn_weights, attn_weights_rest), dim=-1)
 
             attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-            attn_weights0 = attn_weights[..., :q_len]
+            attn_weights0 = attn_weights[..., :q_len].unflatten(1, (self.num_key_value_heads, self.num_key_value_groups))
 
-            attn_output = torch.matmul(attn_weights0, v0)
+            attn_output = torch.matmul(attn_weights0.flatten(2, 3), v0)
+            attn_output = attn_output.view(bsz, self.num_heads, q_len, self.head_dim)
 
-            for i in range(1, lck):
-                vi = cache_v[i]
-                attn_weightsi = attn_weights[..., q_len + i - 1]
-                attn_outputi = attn_weightsi[..., None] * vi
-                attn_output = attn_output + attn_outputi
+            if lck > 1:
+                attn_weights_rest = attn_weights[..., q_len:].unflatten(
+                    1, (self.num_key_value_heads, self.num_key_value_groups)
+                )
+                attn_output_rest = torch.matmul(attn_weights_rest.transpose(2, 3), v_rest)
+                attn_output = attn_output + attn_output_rest.transpose(2, 3).flatten(1, 2)
 
-        attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.reshape(bsz, q_len, self.head_dim * self.num_heads)
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.head_dim * self.num_heads)
         attn_output = self.o_proj(attn_output)
         return attn_output
 
@@ -257,21 +361,19 @@ class Qwen3FlexAttention(Qwen3Attention):
 
         past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
 
-        query_states = self.q_proj(hidden_states)
-        key_states = self.k_proj(hidden_states)
-        value_states = self.v_proj(hidden_states)
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).split(self.qkv_split_sizes, dim=-1)
 
-        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
-        key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
+        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim)
+        key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
         # Qwen3 head-wise norm before RoPE
-        query_states = self.q_norm(query_states)
-        key_states = self.k_norm(key_states)
+        query_states, key_states = self._norm_qk(query_states, key_states)
+        query_states = query_states.transpose(1, 2)
+        key_states = key_states.transpose(1, 2)
 
         lck = past_seen_tokens // q_len
-        cos, sin = self.rotary_emb(query_states, position_ids + lck)
-        cos, sin = cos.to(query_states.device), sin.to(query_states.device)
+        cos, sin = self.rotary_emb(query_states, position_ids + lck, seq_len=q_len + lck)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
 
         cache_position: torch.Tensor = torch.arange(
@@ -317,8 +419,7 @@ class Qwen3FlexAttention(Qwen3Attention):
             block_mask=block_mask,
             enable_gqa=True,
         )
-        attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.reshape(bsz, q_len, self.head_dim * self.num_heads)
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.head_dim * self.num_heads)
         attn_output = self.o_proj(attn_output)
         return attn_output
 
@@ -381,7 +482,13 @@ class Qwen3ForCausalLMEagle3(Eagle3DraftModel):
 
     config_class = Qwen3Config
 
-    def __init__(self, config: Qwen3Config, quant_config=None, attention_backend: str = "flex_attention") -> None:
+    def __init__(
+        self,
+        config: Qwen3Config,
+        quant_config=None,
+        attention_backend: str = "flex_attention",
+        use_compile: bool = False,
+    ) -> None:
         super().__init__(config)
         self.config = config
         self.quant_config = quant_config
@@ -390,6 +497,9 @@ class Qwen3ForCausalLMEagle3(Eagle3DraftModel):
         self.draft_vocab_size = config.draft_vocab_size
         self.embed_tokens = nn.Embedding(config.vocab_size, config.hidden_size, config.pad_token_id)
         self.midlayer = Qwen3DecoderLayer(config, attention_backend=attention_backend)
+        if use_compile:
+            # compile in place so that the state dict keys are unchanged
+            self.midlayer.compile(dynamic=True)
 
         if hasattr(config, "target_hidden_size"):
             self.fc = nn.Linear(config.target_hidden_size * 3, config.hidden_size, bias=False)
@@ -404,6 +514,34 @@ class Qwen3ForCausalLMEagle3(Eagle3DraftModel):
         self.register_buffer("t2d", t2d)
         self.register_buffer("d2t", d2t)
 
+    def _fix_state_dict_keys_on_save(self, state_dict: dict) -> dict:
+        # Checkpoints keep the separate q/k/v and gate/up projection weights, so they stay
+        # loadable by older versions and by serving frameworks.
+        state_dict = dict(super()._fix_state_dict_keys_on_save(state_dict))
+        for name, module in self.named_modules():
+            if isinstance(module, (Qwen3Attention, Qwen3MLP)):
+                module.unfuse_state_dict(state_dict, f"{name}.")
+        return state_dict
+
+    @classmethod
+    def _load_pretrained_model(cls, model, state_dict, checkpoint_files, *args, **kwargs):
+        # from_pretrained matches checkpoint keys to parameters by name, so the separate
+        # weights are fused before that; the draft model is a single layer, so the
+        # checkpoint is simply loaded into memory upfront.
+        if state_dict is None:
+            state_dict = {}
+            for checkpoint_file in checkpoint_files:
+                state_dict.update(
+                    modeling_utils.load_state_dict(checkpoint_file, weights_only=kwargs.get("weights_only", True))
+                )
+        else:
+            state_dict = dict(state_dict)
+        for name, module in model.named_modules():
+            if isinstance(module, (Qwen3Attention, Qwen3MLP)):
+                module.fuse_state_dict(state_dict, f"{name}.")
+        kwargs["sharded_metadata"] = None
+        return super()._load_pretrained_model(model, state_dict, None, *args, **kwargs)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
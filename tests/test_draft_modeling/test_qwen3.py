@@ -0,0 +1,259 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+from safetensors.torch import load_file
+from transformers import Qwen3Config
+
+from specforge.modeling.auto import AutoEagle3DraftModel
+from specforge.modeling.draft.qwen3_eagle import (
+    Qwen3Attention,
+    Qwen3ForCausalLMEagle3,
+    apply_rotary_pos_emb,
+)
+
+
+def make_config():
+    """A tiny Qwen3 draft config shared by the tests below."""
+    config = Qwen3Config(
+        hidden_size=64,
+        intermediate_size=128,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        head_dim=16,
+        vocab_size=256,
+        max_position_embeddings=64,
+    )
+    config.draft_vocab_size = 128
+    return config
+
+
+class TestQwen3ForCausalLMEagle3Loading(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.temp_dir = tempfile.mkdtemp()
+        self.config = make_config()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def save_and_load(self):
+        model = Qwen3ForCausalLMEagle3(self.config, attention_backend="sdpa")
+        model.save_pretrained(self.temp_dir)
+        checkpoint_keys = load_file(
+            os.path.join(self.temp_dir, "model.safetensors")
+        ).keys()
+        loaded_model = AutoEagle3DraftModel.from_pretrained(
+            self.temp_dir, attention_backend="sdpa"
+        )
+        return model, loaded_model, checkpoint_keys
+
+    def test_mlp_checkpoint_round_trip(self):
+        """gate_up_proj is saved as gate_proj/up_proj and fused again on load."""
+        model, loaded_model, checkpoint_keys = self.save_and_load()
+
+        self.assertIn("midlayer.mlp.gate_proj.weight", checkpoint_keys)
+        self.assertIn("midlayer.mlp.up_proj.weight", checkpoint_keys)
+        self.assertNotIn("midlayer.mlp.gate_up_proj.weight", checkpoint_keys)
+        torch.testing.assert_close(
+            loaded_model.midlayer.mlp.gate_up_proj.weight,
+            model.midlayer.mlp.gate_up_proj.weight,
+        )
+
+        gate, up = model.midlayer.mlp.gate_up_proj.weight.chunk(2, dim=0)
+        x = torch.randn(2, 5, self.config.hidden_size)
+        expected = model.midlayer.mlp.down_proj(
+            torch.nn.functional.silu(x @ gate.T) * (x @ up.T)
+        )
+        torch.testing.assert_close(loaded_model.midlayer.mlp(x), expected)
+
+    def test_attention_checkpoint_round_trip(self):
+        """qkv_proj is saved as q_proj/k_proj/v_proj and fused again on load."""
+        model, loaded_model, checkpoint_keys = self.save_and_load()
+
+        q, k, v = (
+            f"midlayer.self_attn.{name}.weight"
+            for name in ("q_proj", "k_proj", "v_proj")
+        )
+        self.assertIn(q, checkpoint_keys)
+        self.assertIn(k, checkpoint_keys)
+        self.assertIn(v, checkpoint_keys)
+        self.assertNotIn("midlayer.self_attn.qkv_proj.weight", checkpoint_keys)
+
+        checkpoint = load_file(os.path.join(self.temp_dir, "model.safetensors"))
+        self.assertEqual(checkpoint[q].shape, (4 * 16, 2 * self.config.hidden_size))
+        self.assertEqual(checkpoint[k].shape, (2 * 16, 2 * self.config.hidden_size))
+        torch.testing.assert_close(
+            loaded_model.midlayer.self_attn.qkv_proj.weight,
+            torch.cat([checkpoint[q], checkpoint[k], checkpoint[v]], dim=0),
+        )
+        torch.testing.assert_close(
+            loaded_model.midlayer.self_attn.qkv_proj.weight,
+            model.midlayer.self_attn.qkv_proj.weight,
+        )
+
+
+class TestQwen3ForCausalLMEagle3Compile(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.config = make_config()
+
+    def run_backbone(self, model, input_embeds, hidden_states, ttt_length=3):
+        """Run the sdpa TTT loop of core/eagle3.py through the backbone."""
+        bsz, seq_length, _ = hidden_states.size()
+        attention_mask = torch.ones(bsz, seq_length, dtype=torch.bool)
+        attention_mask[1, -3:] = False
+        attention_mask = model.prepare_decoder_attention_mask(
+            attention_mask=attention_mask,
+            hidden_states=hidden_states,
+            batch_size=bsz,
+            seq_length=seq_length,
+            past_key_values_length=0,
+        )
+        position_ids = torch.arange(seq_length).expand(bsz, -1)
+        cache_hidden = [[], []]
+        outputs = []
+        for idx in range(ttt_length):
+            hidden_states = model.backbone(
+                input_embeds=input_embeds,
+                hidden_states=hidden_states,
+                cache_hidden=cache_hidden,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+            )
+            outputs.append(hidden_states)
+            ind = torch.arange(seq_length)
+            attention_mask[:, :, ind[idx:], ind[: seq_length - idx]] = torch.finfo(
+                attention_mask.dtype
+            ).min
+        return outputs
+
+    def test_use_compile_matches_eager(self):
+        model = Qwen3ForCausalLMEagle3(self.config, attention_backend="sdpa")
+        compiled_model = Qwen3ForCausalLMEagle3(
+            self.config, attention_backend="sdpa", use_compile=True
+        )
+        compiled_model.load_state_dict(model.state_dict())
+
+        input_embeds = torch.randn(2, 10, self.config.hidden_size)
+        hidden_states = torch.randn(2, 10, self.config.hidden_size, requires_grad=True)
+        outputs = self.run_backbone(model, input_embeds, hidden_states)
+        compiled_outputs = self.run_backbone(
+            compiled_model, input_embeds, hidden_states
+        )
+        for output, compiled_output in zip(outputs, compiled_outputs):
+            torch.testing.assert_close(compiled_output, output, rtol=1e-5, atol=1e-5)
+
+        loss = sum(o.square().sum() for o in outputs)
+        compiled_loss = sum(o.square().sum() for o in compiled_outputs)
+        grads = torch.autograd.grad(
+            loss, [hidden_states] + list(model.midlayer.parameters())
+        )
+        compiled_grads = torch.autograd.grad(
+            compiled_loss, [hidden_states] + list(compiled_model.midlayer.parameters())
+        )
+        for grad, compiled_grad in zip(grads, compiled_grads):
+            torch.testing.assert_close(compiled_grad, grad, rtol=1e-4, atol=1e-4)
+
+
+def reference_cache_attention(
+    attn, hidden_states_per_step, attention_mask, position_ids
+):
+    """
+    The original TTT cache branch of Qwen3Attention: kv heads repeated for GQA and the
+    cached keys/values of later steps attended one step at a time.
+    """
+    cache_k, cache_v, outputs = [], [], []
+    scale = attn.head_dim**-0.5
+    for hidden_states in hidden_states_per_step:
+        bsz, q_len, _ = hidden_states.size()
+        query, key, value = attn.qkv_proj(hidden_states).split(
+            attn.qkv_split_sizes, dim=-1
+        )
+        query = attn.q_norm(query.view(bsz, q_len, -1, attn.head_dim)).transpose(1, 2)
+        key = attn.k_norm(key.view(bsz, q_len, -1, attn.head_dim)).transpose(1, 2)
+        value = value.view(bsz, q_len, -1, attn.head_dim).transpose(1, 2)
+        lck = len(cache_k)
+        cos, sin = attn.rotary_emb(query, position_ids + lck, seq_len=q_len + lck)
+        query, key = apply_rotary_pos_emb(query, key, cos, sin)
+        cache_k.append(key.repeat_interleave(attn.num_key_value_groups, dim=1))
+        cache_v.append(value.repeat_interleave(attn.num_key_value_groups, dim=1))
+
+        attn_weights = (
+            torch.matmul(query, cache_k[0].transpose(2, 3)) * scale + attention_mask
+        )
+        for key_i in cache_k[1:]:
+            attn_weights_i = (query * key_i).sum(-1) * scale
+            attn_weights = torch.cat((attn_weights, attn_weights_i[..., None]), dim=-1)
+        attn_weights = torch.softmax(attn_weights, dim=-1, dtype=torch.float32).to(
+            query.dtype
+        )
+
+        attn_output = torch.matmul(attn_weights[..., :q_len], cache_v[0])
+        for i, value_i in enumerate(cache_v[1:]):
+            attn_output = attn_output + attn_weights[..., q_len + i, None] * value_i
+        outputs.append(attn.o_proj(attn_output.transpose(1, 2).reshape(bsz, q_len, -1)))
+    return outputs
+
+
+class TestQwen3AttentionCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.config = make_config()
+        self.bsz, self.q_len, self.ttt_length = 2, 10, 3
+
+        causal = torch.full(
+            (self.q_len, self.q_len), torch.finfo(torch.float32).min
+        ).triu(1)
+        self.attention_mask = causal.expand(self.bsz, 1, -1, -1).clone()
+        # padding at the end of the second sequence
+        self.attention_mask[1, :, :, -3:] = torch.finfo(torch.float32).min
+        self.position_ids = torch.arange(self.q_len).expand(self.bsz, -1)
+
+    def check_against_reference(self, attn, forward):
+        hidden_states = [
+            torch.randn(
+                self.bsz, self.q_len, 2 * self.config.hidden_size, requires_grad=True
+            )
+            for _ in range(self.ttt_length)
+        ]
+        cache_hidden = [[], []]
+        outputs = [
+            forward(
+                h,
+                cache_hidden=cache_hidden,
+                attention_mask=self.attention_mask,
+                position_ids=self.position_ids,
+            )
+            for h in hidden_states
+        ]
+        expected = reference_cache_attention(
+            attn, hidden_states, self.attention_mask, self.position_ids
+        )
+        for output, expected_output in zip(outputs, expected):
+            torch.testing.assert_close(output, expected_output, rtol=1e-5, atol=1e-5)
+
+        tensors = hidden_states + list(attn.parameters())
+        grads = torch.autograd.grad(sum(o.square().sum() for o in outputs), tensors)
+        expected_grads = torch.autograd.grad(
+            sum(o.square().sum() for o in expected), tensors
+        )
+        for grad, expected_grad in zip(grads, expected_grads):
+            torch.testing.assert_close(grad, expected_grad, rtol=1e-4, atol=1e-5)
+
+    def test_cache_branch_matches_reference(self):
+        attn = Qwen3Attention(self.config)
+        self.check_against_reference(attn, attn)
+
+    def test_compiled_cache_branch_matches_reference(self):
+        attn = Qwen3Attention(self.config)
+        self.check_against_reference(attn, torch.compile(attn, dynamic=True))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
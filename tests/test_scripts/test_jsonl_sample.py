@@ -0,0 +1,218 @@
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+SCRIPT_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "scripts", "jsonl_sample.py"
+)
+
+spec = importlib.util.spec_from_file_location("jsonl_sample", SCRIPT_PATH)
+jsonl_sample = importlib.util.module_from_spec(spec)
+# registered so that worker processes can unpickle functions of the script
+sys.modules[spec.name] = jsonl_sample
+spec.loader.exec_module(jsonl_sample)
+
+
+class TestValidateJsonlLine(unittest.TestCase):
+
+    VALID = [
+        b'{"a": 1, "b": [true, null, "x"]}',
+        b'  {"a": 1}  ',
+        b'{"big": 123456789012345678901234567890}',
+        b"-9223372036854775809",
+        b'\xef\xbb\xbf{"a": 1}',
+        '{"text": "é"}',
+    ]
+    INVALID = [
+        b"",
+        b'{"a": 1,}',
+        b'{"a": 1}{"b": 2}',
+        b'{"a": NaN}',
+        b"[Infinity, -Infinity]",
+        b"1e400",
+        b'{"a": "\xff"}',
+    ]
+
+    def parsers(self):
+        """Yield once for every parser that validate_jsonl_line can use here."""
+        if jsonl_sample._PARSER is not None:
+            yield "simdjson"
+        with patch.object(jsonl_sample, "_PARSER", None):
+            if jsonl_sample.orjson is not None:
+                yield "orjson"
+            with patch.object(jsonl_sample, "orjson", None):
+                yield "json"
+
+    def test_parsers_agree(self):
+        for parser in self.parsers():
+            for line in self.VALID:
+                with self.subTest(parser=parser, line=line):
+                    self.assertTrue(jsonl_sample.validate_jsonl_line(line))
+            for line in self.INVALID:
+                with self.subTest(parser=parser, line=line):
+                    self.assertFalse(jsonl_sample.validate_jsonl_line(line))
+
+    @unittest.skipIf(jsonl_sample._PARSER is None, "simdjson is not installed")
+    def test_parser_in_use(self):
+        """A document still referencing the shared parser falls back instead of raising."""
+        document = jsonl_sample._PARSER.parse(b'{"a": 1}')
+        self.assertTrue(jsonl_sample.validate_jsonl_line(b'{"b": 2}'))
+        self.assertFalse(jsonl_sample.validate_jsonl_line(b'{"b": }'))
+        del document
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.temp_dir, "input.jsonl")
+        lines = [
+            json.dumps({"id": i, "text": "x" * (i % 37)}).encode() for i in range(3000)
+        ]
+        lines[10] = b'{"broken": '
+        lines[20] = b""
+        # CRLF line endings and no newline after the last line
+        lines[30] += b"\r"
+        self.data = b"\n".join(lines)
+        with open(self.input_path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def output(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def read_lines(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.assertTrue(data.endswith(b"\n"))
+        return data.split(b"\n")[:-1]
+
+    def test_iter_lines_matches_split(self):
+        for chunk_size in (1, 7, 4096, 1 << 20):
+            with self.subTest(chunk_size=chunk_size):
+                lines = list(
+                    jsonl_sample.iter_lines(self.input_path, chunk_size=chunk_size)
+                )
+                self.assertEqual([line for _, line in lines], self.data.split(b"\n"))
+                self.assertEqual(
+                    [pos for pos, _ in lines], list(range(1, len(lines) + 1))
+                )
+
+    def test_line_ranges_cover_file(self):
+        for num_parts in (1, 2, 3, 8, 100):
+            with self.subTest(num_parts=num_parts):
+                ranges = jsonl_sample.split_line_ranges(self.input_path, num_parts)
+                self.assertLessEqual(len(ranges), num_parts)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], len(self.data))
+                lines = []
+                for (start, end), next_range in zip(ranges, ranges[1:] + [None]):
+                    self.assertTrue(start == 0 or self.data[start - 1 : start] == b"\n")
+                    if next_range is not None:
+                        self.assertEqual(end, next_range[0])
+                    lines += [
+                        line
+                        for _, line in jsonl_sample.iter_lines(
+                            self.input_path, 5, start, end
+                        )
+                    ]
+                self.assertEqual(lines, self.data.split(b"\n"))
+
+    def test_fraction_independent_of_workers(self):
+        for validate in (False, True):
+            results = {}
+            for workers in (1, 4):
+                output_path = self.output(f"fraction_{workers}.jsonl")
+                counts = jsonl_sample.sample_fraction(
+                    self.input_path,
+                    output_path,
+                    0.3,
+                    seed=7,
+                    validate=validate,
+                    workers=workers,
+                )
+                with open(output_path, "rb") as f:
+                    results[workers] = (counts, f.read())
+            with self.subTest(validate=validate):
+                self.assertEqual(results[1], results[4])
+                total_seen, valid_seen, written = results[1][0]
+                self.assertEqual(total_seen, 3000)
+                self.assertEqual(valid_seen, 2998 if validate else 3000)
+                self.assertEqual(
+                    len(self.read_lines(self.output("fraction_4.jsonl"))), written
+                )
+                self.assertLess(abs(written - 0.3 * valid_seen), 0.05 * valid_seen)
+        self.assertFalse(
+            [name for name in os.listdir(self.temp_dir) if name.endswith(".part")]
+        )
+
+    def test_fixed_size(self):
+        input_lines = self.data.split(b"\n")
+        output_path = self.output("fixed.jsonl")
+        total_seen, valid_seen = jsonl_sample.sample_fixed_size(
+            self.input_path, output_path, 100, seed=3, validate=True
+        )
+        self.assertEqual((total_seen, valid_seen), (3000, 2998))
+        sampled = self.read_lines(output_path)
+        self.assertEqual(len(sampled), 100)
+        # lines keep their input order
+        positions = [input_lines.index(line) for line in sampled]
+        self.assertEqual(positions, sorted(positions))
+        self.assertTrue(all(jsonl_sample.validate_jsonl_line(line) for line in sampled))
+
+        # deterministic for a seed
+        jsonl_sample.sample_fixed_size(
+            self.input_path, self.output("again.jsonl"), 100, seed=3, validate=True
+        )
+        self.assertEqual(self.read_lines(self.output("again.jsonl")), sampled)
+        jsonl_sample.sample_fixed_size(
+            self.input_path, self.output("other.jsonl"), 100, seed=4, validate=True
+        )
+        self.assertNotEqual(self.read_lines(self.output("other.jsonl")), sampled)
+
+    def test_negative_seed(self):
+        output_path = self.output("negative.jsonl")
+        jsonl_sample.sample_fixed_size(self.input_path, output_path, 100, seed=-1)
+        sampled = self.read_lines(output_path)
+        self.assertEqual(len(sampled), 100)
+        jsonl_sample.sample_fixed_size(
+            self.input_path, self.output("again.jsonl"), 100, seed=-1
+        )
+        self.assertEqual(self.read_lines(self.output("again.jsonl")), sampled)
+
+        counts = jsonl_sample.sample_fraction(
+            self.input_path, self.output("fraction.jsonl"), 0.3, seed=-1
+        )
+        self.assertEqual(len(self.read_lines(self.output("fraction.jsonl"))), counts[2])
+
+    def test_fixed_size_larger_than_input(self):
+        output_path = self.output("all.jsonl")
+        jsonl_sample.sample_fixed_size(self.input_path, output_path, 5000, seed=0)
+        # the unterminated last line is written with a newline
+        self.assertEqual(self.read_lines(output_path), self.data.split(b"\n"))
+
+    def test_fixed_size_is_uniform(self):
+        input_path = self.output("small.jsonl")
+        with open(input_path, "wb") as f:
+            f.write(b"".join(b"%d\n" % i for i in range(20)))
+        counts = [0] * 20
+        num_runs = 1000
+        for seed in range(num_runs):
+            output_path = self.output("sample.jsonl")
+            jsonl_sample.sample_fixed_size(input_path, output_path, 5, seed=seed)
+            for line in self.read_lines(output_path):
+                counts[int(line)] += 1
+        # every line is kept with probability 5 / 20; allow about 5 standard deviations
+        for count in counts:
+            self.assertLess(abs(count - num_runs / 4), 70)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)